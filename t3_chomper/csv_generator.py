@@ -1,7 +1,6 @@
 """CLI for generating CSV import files for SiriusT3 instrument"""
 
 import click
-from io import StringIO
 
 from t3_chomper.formatters import (
     generate_registration_pka_file,
@@ -87,11 +86,12 @@ def t3_gencsv(regi, pka, filter_file, sample_col, output, protocol, concentratio
         concentration_mM=concentration,
         volume_ul=volume,
     )
-    buffer = StringIO(merged_df.to_csv(None, index=False))
     # Pass solvent parameter for logp protocol
     if protocol.name.lower() == "logp":
-        formatter = protocol.value(input_csv=buffer, sample_id_col=sample_col, solvent=logp_solvent)
+        formatter = protocol.value.from_dataframe(
+            merged_df, sample_id_col=sample_col, solvent=logp_solvent
+        )
     else:
-        formatter = protocol.value(input_csv=buffer, sample_id_col=sample_col)
+        formatter = protocol.value.from_dataframe(merged_df, sample_id_col=sample_col)
     click.echo(f"Found {formatter.num_samples} samples with estimated pKa values.")
     formatter.generate_csv_files(output_dir=output)
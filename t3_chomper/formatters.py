@@ -1,7 +1,8 @@
 from abc import ABC, abstractmethod
 import enum
+import importlib.util
 import pathlib
-from typing import Union
+from typing import Iterator, Optional, Union
 
 import pandas as pd
 
@@ -9,6 +10,11 @@ from t3_chomper.logger import get_logger
 
 logger = get_logger(__name__)
 
+# pyarrow is optional. When installed, use its multithreaded CSV reader and Arrow-backed string columns
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+CSV_ENGINE = "pyarrow" if HAS_PYARROW else "c"
+STRING_DTYPE = "string[pyarrow]" if HAS_PYARROW else "string"
+
 
 def convert_long_pka_df(
     long_df: pd.DataFrame,
@@ -34,23 +40,78 @@ def convert_long_pka_df(
     """
     for col in [id_col, pka_col, pka_type_col]:
         if col not in long_df.columns:
-            logger.error(f"Missing expected column {col} ")
+            logger.error("Missing expected column %s ", col)
             raise ValueError(f"Missing expected column {col} ")
     # Sort by compound and ascending pKa value
     long_df.sort_values([id_col, pka_col], inplace=True)
-    # Aggregate to one row per compound, with a list for pKa types and values
-    agg_df = long_df.groupby(id_col)[[pka_type_col, pka_col]].agg(list).reset_index()
-    # Generate reformatted pKa string
-    agg_df[reformatted_pka_col] = agg_df.apply(
-        lambda x: ",".join(
-            f"{t.upper()},{v}"
-            for t, v in zip(getattr(x, pka_type_col), getattr(x, pka_col))
-        ),
-        axis=1,
+    # Compound IDs and pKa types repeat across rows, so group on categorical codes instead of strings
+    long_df[id_col] = long_df[id_col].astype("category")
+    long_df[pka_type_col] = long_df[pka_type_col].astype("category")
+    # Build the "<TYPE>,<value>" pair for every row, then join the pairs per compound
+    pairs = long_df[pka_type_col].str.upper() + "," + long_df[pka_col].astype(str)
+    agg_df = (
+        pairs.groupby(long_df[id_col], sort=False, observed=True)
+        .agg(",".join)
+        .reset_index(name=reformatted_pka_col)
     )
     return agg_df
 
 
+def _read_csv(filepath_or_buffer, **kwargs) -> pd.DataFrame:
+    """
+    Read a CSV file with CSV_ENGINE. Numeric columns are always numpy-backed, so e.g. an integer column with
+    blank cells is read as float64 and written as "1.0", as without pyarrow. Only columns given STRING_DTYPE
+    are Arrow-backed.
+    The pyarrow reader is stricter than the C reader about rows with extra fields, so fall back to the C reader
+    when it fails to parse the file.
+    The pyarrow reader infers column types before applying dtype, so e.g. sample IDs "001" and "1" would both
+    become "1". Files read with explicit dtypes therefore always use the C reader.
+    """
+    if CSV_ENGINE == "pyarrow" and not kwargs.get("dtype"):
+        try:
+            return pd.read_csv(filepath_or_buffer, engine="pyarrow", **kwargs)
+        except pd.errors.ParserError as e:
+            logger.debug("pyarrow could not parse CSV, using the C reader: %s", e)
+            if hasattr(filepath_or_buffer, "seek"):
+                filepath_or_buffer.seek(0)
+    return pd.read_csv(filepath_or_buffer, **kwargs)
+
+
+def read_csv_columns(
+    filepath_or_buffer,
+    columns: list[str],
+    dtypes: Union[dict[str, str], None] = None,
+    required: Union[list[str], None] = None,
+) -> pd.DataFrame:
+    """
+    Read a subset of columns from a CSV file.
+    Column names are matched case-insensitively and returned in lowercase.
+    Only the header is read to resolve the column names, so unused columns are never parsed.
+
+    Args:
+        filepath_or_buffer: CSV file or buffer to read
+        columns: lowercase names of the columns to read, missing columns are skipped
+        dtypes: optional mapping of lowercase column name to dtype
+        required: optional lowercase names of columns that must be present. These are checked against the
+            header, so a file missing one is rejected without parsing its rows.
+    """
+    dtypes = dtypes or {}
+    header = pd.read_csv(filepath_or_buffer, nrows=0).columns
+    header_lower = set(header.str.lower())
+    for col in required or []:
+        if col not in header_lower:
+            msg = f"Expected column {col} is missing in {filepath_or_buffer}"
+            logger.error(msg)
+            raise ValueError(msg)
+    if hasattr(filepath_or_buffer, "seek"):
+        filepath_or_buffer.seek(0)
+    usecols = [col for col in header if col.lower() in columns]
+    dtype = {col: dtypes[col.lower()] for col in usecols if col.lower() in dtypes}
+    return _read_csv(filepath_or_buffer, usecols=usecols, dtype=dtype).rename(
+        columns=str.lower
+    )
+
+
 def generate_registration_pka_file(
     registration_csv: str,
     pka_csv: str,
@@ -72,69 +133,91 @@ def generate_registration_pka_file(
         concentration_mM: sample concentration in mM (default: 10.0)
         volume_ul: sample volume in µL (default: 5.0)
     Returns:
-        Merged dataframe with columns from the registration_csv and the estimated pKa data from the pKa data file
+        Merged dataframe with the sample, well, mw, fw and mg columns from the registration_csv (where present)
+        and the estimated pKa data from the pKa data file. The sample column is categorical.
     """
 
     sample_col = sample_col.lower()
+    pkas_col = "reformatted_pkas"
 
-    # convert regi file columns to lowercase
-    regi_df = pd.read_csv(registration_csv).rename(columns=str.lower)
-    logger.info(f"Read regi file {registration_csv} with {len(regi_df)} rows.")
-
-    # Regi file must have sample_col, well and MW columns
-    regi_required_columns = [
-        sample_col,
-        "well",
-        "mw",
-    ]
-    for col in regi_required_columns:
-        if col not in regi_df.columns:
-            msg = f"Expected column {col} is missing in {registration_csv}"
-            logger.error(msg)
-            raise ValueError(msg)
+    # Read only the regi columns used by the tray formats, column names are converted to lowercase
+    regi_df = read_csv_columns(
+        registration_csv,
+        columns=[sample_col, "well", "mw", "fw", "mg"],
+        dtypes={sample_col: STRING_DTYPE, "well": STRING_DTYPE},
+        # Regi file must have sample_col, well and MW columns
+        required=[sample_col, "well", "mw"],
+    )
+    logger.info("Read regi file %s with %s rows.", registration_csv, len(regi_df))
 
     # Handle use of filter file to sub-select rows from regi file
     if filter_file is not None:
-        filter_df = pd.read_csv(filter_file).rename(columns=str.lower)
-        logger.info(f"Read filter file {filter_file} with {len(filter_df)} rows.")
-        if sample_col not in filter_df:
-            msg = f"Expected column {sample_col} in {filter_file}"
-            logger.error(msg)
-            raise ValueError(msg)
+        filter_df = read_csv_columns(
+            filter_file,
+            columns=[sample_col],
+            dtypes={sample_col: STRING_DTYPE},
+            required=[sample_col],
+        )
+        logger.info("Read filter file %s with %s rows.", filter_file, len(filter_df))
         regi_df = regi_df[regi_df[sample_col].isin(filter_df[sample_col])]
         num_pass_filter = len(regi_df)
         if num_pass_filter == 0:
             msg = f"No matches between regi file and filter file!"
             logger.error(msg)
             raise ValueError(msg)
-        logger.info(f"After using filter file, {len(regi_df)} rows remain.")
-
-    # Read pKa file
-    pka_df = pd.read_csv(pka_csv).rename(columns=str.lower)
-    if sample_col not in pka_df.columns:
-        raise ValueError(f"Expected column {sample_col} is missing in {pka_csv}")
+        logger.info("After using filter file, %s rows remain.", len(regi_df))
+
+    # Read pKa file, keeping the columns for either the short or the long format
+    pka_df = read_csv_columns(
+        pka_csv,
+        columns=[sample_col, pkas_col, "pka_value", "pka_type"],
+        dtypes={
+            sample_col: STRING_DTYPE,
+            pkas_col: STRING_DTYPE,
+            "pka_type": STRING_DTYPE,
+        },
+        required=[sample_col],
+    )
 
     # If the pKa data file is in the long-format with one row per pKa, then try to reformat
     # to generate a 'short-format' pKa file with one row per compound and column "reformatted_pkas"
-    pkas_col = "reformatted_pkas"
     if pkas_col not in pka_df.columns:
         pka_df = convert_long_pka_df(pka_df, id_col=sample_col)
 
-    pka_df = pka_df[[sample_col, pkas_col]]
+    pka_df = pka_df[[sample_col, pkas_col]].dropna(subset=pkas_col)
 
-    # left join on regi file, unmatched rows will have null pKa values
-    merged_df = pd.merge(regi_df, pka_df, how="left", on=sample_col)
-
-    # Warn if there are rows with unmatched pKa values
-    missing_row_count = merged_df[pkas_col].isna().sum()
+    # Drop regi rows without pKa data before joining, warning about the ones that are dropped
+    has_pka = regi_df[sample_col].isin(pka_df[sample_col]).to_numpy()
+    missing_pka = ~has_pka
+    missing_row_count = missing_pka.sum()
     if missing_row_count > 0:
-        missing_row_ids = merged_df[merged_df[pkas_col].isna()][sample_col]
+        missing_row_ids = regi_df[sample_col].to_numpy()[missing_pka]
         logger.warning(
-            f"{missing_row_count} rows have missing pKa data and will be dropped: {missing_row_ids}"
+            "%s rows have missing pKa data and will be dropped: %s",
+            missing_row_count,
+            missing_row_ids,
         )
-    # Drop rows with no pKa data
-    merged_df.dropna(subset=pkas_col, inplace=True)
-    logger.info(f"Merged data has {len(merged_df)} rows with pKa data.")
+    regi_df = regi_df[has_pka]
+
+    # Give both sample columns the same categorical dtype, so the join compares integer codes instead of strings
+    sample_dtype = pd.CategoricalDtype(regi_df[sample_col].dropna().unique())
+    regi_df = regi_df.assign(**{sample_col: regi_df[sample_col].astype(sample_dtype)})
+    pka_samples = pka_df[sample_col]
+    if isinstance(pka_samples.dtype, pd.CategoricalDtype):
+        # Long-format pKa samples are already categorical, and astype does not recode them when the
+        # categories are the same but in a different order, so set the categories explicitly
+        pka_samples = pka_samples.cat.set_categories(sample_dtype.categories)
+    else:
+        pka_samples = pka_samples.astype(sample_dtype)
+    pka_df = pka_df.assign(**{sample_col: pka_samples})
+
+    # Join on the sample column as the index of both frames, keeping the regi row order
+    merged_df = (
+        regi_df.set_index(sample_col)
+        .join(pka_df.set_index(sample_col), how="inner")
+        .reset_index()
+    )
+    logger.info("Merged data has %s rows with pKa data.", len(merged_df))
 
     # Add concentration and volume columns
     merged_df["concentration_mm"] = concentration_mM
@@ -143,6 +226,17 @@ def generate_registration_pka_file(
     return merged_df
 
 
+def _join_fields(*fields: Union[pd.Series, str]) -> pd.Series:
+    """
+    Join string Series and literal strings element-wise with commas, giving one CSV line per row.
+    At least one of the fields must be a Series.
+    """
+    line = fields[0]
+    for field in fields[1:]:
+        line = line + "," + field
+    return line
+
+
 class SiriusT3CSVGenerator(ABC):
     """
     Abstract class used to generate CSV import file(s) for loading samples into a SiriusT3 instrument.
@@ -156,6 +250,8 @@ class SiriusT3CSVGenerator(ABC):
 
     Args:
         input_csv: input data file with compound IDs and estimated pKas
+        input_df: input data already loaded as a dataframe, used instead of input_csv.
+            See also from_dataframe.
         pkas_col: name for the column containing the estimated pKas
         sample_id_col: name for column containing the sample names
         fw_col: name for column with formula weights
@@ -165,10 +261,14 @@ class SiriusT3CSVGenerator(ABC):
     """
 
     SAMPLES_PER_TRAY = 48
+    # Column holding the pre-built sample section line for each sample
+    _SAMPLE_LINE_COL = "_sample_line"
+    # Maximum number of sample IDs listed in error messages
+    _MAX_REPORTED_IDS = 20
 
     def __init__(
         self,
-        input_csv: str,
+        input_csv: Optional[str] = None,
         pkas_col: str = "reformatted_pkas",
         sample_id_col: str = "sample",
         fw_col: str = "fw",
@@ -176,7 +276,10 @@ class SiriusT3CSVGenerator(ABC):
         well_col: str = "well",
         mw_col: str = "mw",
         solvent: str = "none",
+        input_df: Optional[pd.DataFrame] = None,
     ):
+        if (input_csv is None) == (input_df is None):
+            raise ValueError("Exactly one of input_csv or input_df must be provided")
         self._input_csv = input_csv
         self._pkas_col = pkas_col
         self._sample_id_col = sample_id_col
@@ -186,10 +289,28 @@ class SiriusT3CSVGenerator(ABC):
         self._mw_col = mw_col
         self._solvent = solvent
 
-        self._df = self._load_input_file()
+        if input_df is None:
+            # Only the required columns are written to the tray files, so skip parsing the others
+            input_df = read_csv_columns(
+                self._input_csv,
+                columns=self.required_columns,
+            )
+        self._df = self._load_input_file(input_df)
+        self._num_samples = len(self._df)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, **kwargs) -> "SiriusT3CSVGenerator":
+        """
+        Create a generator from input data that is already loaded, e.g. the merged output of
+        generate_registration_pka_file, without writing it out and re-reading it as CSV.
+        Args:
+            df: input data with compound IDs and estimated pKas
+            kwargs: other keyword arguments for the generator, e.g. sample_id_col
+        """
+        return cls(input_df=df, **kwargs)
 
     @property
-    def input_csv(self) -> str:
+    def input_csv(self) -> Optional[str]:
         return self._input_csv
 
     @property
@@ -209,20 +330,53 @@ class SiriusT3CSVGenerator(ABC):
         """
         return []
 
-    def _load_input_file(self) -> pd.DataFrame:
-        df = pd.read_csv(self._input_csv)
-        df.rename(columns=str.lower, inplace=True)
-        for col in self.base_required_columns + self.additional_required_columns:
+    @property
+    def required_columns(self) -> list[str]:
+        """Return list of all columns required by this tray format"""
+        return self.base_required_columns + self.additional_required_columns
+
+    def _load_input_file(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Validate the input data and prepare it for writing tray files"""
+        required_columns = self.required_columns
+        sample_id_col = self._sample_id_col
+        pkas_col = self._pkas_col
+        df = df.rename(columns=str.lower)
+        for col in required_columns:
             if col not in df.columns:
                 msg = f"""Column "{col}" not found in regi file"""
                 logger.error(msg)
                 raise ValueError(msg)
-        missing_pkas_count = df[self._pkas_col].isna().sum()
+        missing_pkas = df[pkas_col].isna().to_numpy()
+        missing_pkas_count = int(missing_pkas.sum())
         if missing_pkas_count:
-            missing_row_ids = df[df[self._pkas_col].isna()][self._sample_id_col]
+            # Only list the first few IDs, so the message stays short however many are missing
+            missing_row_ids = df[sample_id_col].to_numpy()[missing_pkas][
+                : self._MAX_REPORTED_IDS
+            ]
             raise ValueError(
-                f"Input file has {missing_pkas_count} missing estimated pKas: {missing_row_ids}"
+                f"Input file has {missing_pkas_count} missing estimated pKas "
+                f"(first {self._MAX_REPORTED_IDS}): {missing_row_ids.tolist()}"
             )
+        # Every required column is written into the tray files as text, so convert them once here
+        # rather than on every tray slice. Missing values, e.g. a blank well or MW, are written as "nan"
+        # whatever the column's dtype, rather than as "<NA>".
+        df = df.assign(
+            **{
+                col: df[col]
+                .astype(object)
+                .where(df[col].notna(), float("nan"))
+                .astype(str)
+                .astype(STRING_DTYPE)
+                for col in required_columns
+            }
+        )
+        # The sample section line for each sample does not depend on the tray, so build it once
+        df[self._SAMPLE_LINE_COL] = _join_fields(
+            df[sample_id_col],
+            df[pkas_col].str.rstrip(","),
+            "SYM," + df[self._well_col],
+            "MW," + df[self._mw_col],
+        )
         return df
 
     def generate_header_section(self) -> str:
@@ -230,19 +384,7 @@ class SiriusT3CSVGenerator(ABC):
 
     def generate_sample_section(self, sample_df: pd.DataFrame) -> str:
         """Generate section of the SiriusT3 CSV import file with Sample information"""
-        lines = []
-        for row in sample_df.itertuples():
-            lines.append(
-                ",".join(
-                    [
-                        f"{getattr(row, self._sample_id_col)}",
-                        f"{getattr(row, self._pkas_col).rstrip(',')}",
-                        f"""SYM,{getattr(row, self._well_col)}""",
-                        f"""MW,{getattr(row, self._mw_col)}""",
-                    ]
-                )
-            )
-        return "\n".join(lines)
+        return "\n".join(sample_df[self._SAMPLE_LINE_COL].tolist())
 
     @abstractmethod
     def generate_experiment_section(self, sample_df: pd.DataFrame) -> str:
@@ -252,14 +394,12 @@ class SiriusT3CSVGenerator(ABC):
     @property
     def num_samples(self):
         """Total number of samples in input"""
-        return self._df.shape[0]
+        return self._num_samples
 
-    def _get_split_dfs(self) -> list[pd.DataFrame]:
-        """Split samples in input into chunks for each tray"""
-        return [
-            self._df.iloc[i : i + self.SAMPLES_PER_TRAY]
-            for i in range(0, self.num_samples, self.SAMPLES_PER_TRAY)
-        ]
+    def _get_split_dfs(self) -> Iterator[pd.DataFrame]:
+        """Split samples in input into chunks for each tray, slicing each tray only when it is needed"""
+        for start in range(0, self._num_samples, self.SAMPLES_PER_TRAY):
+            yield self._df.iloc[start : start + self.SAMPLES_PER_TRAY]
 
     def generate_csv_files(self, output_dir) -> None:
         """Generate CSV files for import"""
@@ -269,15 +409,19 @@ class SiriusT3CSVGenerator(ABC):
 
         for idx, tray_df in enumerate(self._get_split_dfs()):
             tray_name = f"""{output_dir.strip("/")}_{idx}"""
-            outstr = self.generate_header_section()
-            outstr += self.generate_sample_section(tray_df)
-            outstr += f"""\n\nTRAY,{tray_name}\n"""
-            outstr += self.generate_experiment_section(tray_df)
+            parts = [
+                self.generate_header_section(),
+                self.generate_sample_section(tray_df),
+                f"""\n\nTRAY,{tray_name}\n""",
+                self.generate_experiment_section(tray_df),
+            ]
 
             output_filename = output_path / f"tray_{idx}.csv"
-            with open(output_filename, "w") as fout:
-                fout.write(outstr)
-            logger.info(f"Wrote to {output_filename}")
+            # Tray files are small, so a 1 MiB buffer holds a whole file and it is written in one system call
+            with open(output_filename, "w", buffering=1 << 20) as fout:
+                # Write each section into the file buffer instead of joining them into one string first
+                fout.writelines(parts)
+            logger.info("Wrote to %s", output_filename)
 
 
 class FastUVPSKAGenerator(SiriusT3CSVGenerator):
@@ -290,23 +434,17 @@ class FastUVPSKAGenerator(SiriusT3CSVGenerator):
         and then "Fast UV psKa" for 47 samples, each at 0.005 mL and 10 mM in pure DMSO
         """
 
-        lines = []
-        for row in sample_df.itertuples():
-            sample_name = getattr(row, self._sample_id_col)
-            # TODO: should we specify a well location here? What about FW?
-            lines.append(
-                ",".join(
-                    [
-                        "Fast UV psKa",
-                        f"title,pka of {sample_name}",
-                        f"{sample_name}",
-                        f"{sample_name},1",
-                        "volume,0.005",
-                        "Concentration,10",
-                        "DMSO,1",
-                    ]
-                )
-            )
+        sample_names = sample_df[self._sample_id_col]
+        # TODO: should we specify a well location here? What about FW?
+        lines = _join_fields(
+            "Fast UV psKa",
+            "title,pka of " + sample_names,
+            sample_names,
+            sample_names + ",1",
+            "volume,0.005",
+            "Concentration,10",
+            "DMSO,1",
+        )
         return "Fast UV Buffer Calib MeOH\n" + "\n".join(lines)
 
 
@@ -319,22 +457,16 @@ class UVMetricPSKAGenerator(SiriusT3CSVGenerator):
         Tray has 24 samples, a calibration assay is automatically added before each sample.
         This assumes that each sample is at 0.005 mL and 10 mM in pure DMSO
         """
-        lines = []
-        for row in sample_df.itertuples():
-            sample_name = getattr(row, self._sample_id_col)
-            lines.append(
-                ",".join(
-                    [
-                        "UV-metric psKa",
-                        f"title,UV-metric psKa of {sample_name} by volume",
-                        f"{sample_name}",  # sample
-                        f"{sample_name},1",  # component and stoichiometry
-                        "volume,0.005",
-                        "Concentration,10",
-                        "DMSO,1",
-                    ]
-                )
-            )
+        sample_names = sample_df[self._sample_id_col]
+        lines = _join_fields(
+            "UV-metric psKa",
+            "title,UV-metric psKa of " + sample_names + " by volume",
+            sample_names,  # sample
+            sample_names + ",1",  # component and stoichiometry
+            "volume,0.005",
+            "Concentration,10",
+            "DMSO,1",
+        )
         return "\n".join(lines)
 
 
@@ -354,22 +486,16 @@ class PHMetricPSKAGenerator(SiriusT3CSVGenerator):
         Tray has 24 samples, with a "Clean Up" step after every sample.
         Samples are solid powder, so mg is specified.
         """
-        lines = []
-        for row in sample_df.itertuples():
-            sample_name = getattr(row, self._sample_id_col)
-            lines.append(
-                ",".join(
-                    [
-                        "pH-metric psKa",
-                        f"title,pH-metric psKa of {sample_name} by weight",
-                        f"{sample_name}",  # sample
-                        f"{sample_name},1",  # component and stoichiometry
-                        f"""fw,{getattr(row, self._fw_col)}""",
-                        f"""mg,{getattr(row, self._mg_col)}""",
-                    ]
-                )
-            )
-            lines.append("Clean Up")
+        sample_names = sample_df[self._sample_id_col]
+        lines = _join_fields(
+            "pH-metric psKa",
+            "title,pH-metric psKa of " + sample_names + " by weight",
+            sample_names,  # sample
+            sample_names + ",1",  # component and stoichiometry
+            "fw," + sample_df[self._fw_col],
+            "mg," + sample_df[self._mg_col],
+        )
+        lines = lines + "\nClean Up"
         return "\n".join(lines)
 
 
@@ -388,23 +514,16 @@ class LogPGenerator(SiriusT3CSVGenerator):
         Generate the experimental section for the "pH-metric medium logP" template.
         This has 16 samples with 2x cleanup steps in between samples in each plate
         """
-        lines = []
-        for row in sample_df.itertuples():
-            sample_name = getattr(row, self._sample_id_col)
-            lines.append(
-                ",".join(
-                    [
-                        f"pH-metric medium logP {self._solvent}",
-                        f"title,logP of {sample_name}",
-                        f"{sample_name}",
-                        f"{sample_name},1",
-                        f"""fw,{getattr(row, self._fw_col)}""",
-                        f"""mg, {getattr(row, self._mg_col)}""",
-                    ]
-                )
-            )
-            lines.append("Clean Up")
-            lines.append("Clean Up")
+        sample_names = sample_df[self._sample_id_col]
+        lines = _join_fields(
+            f"pH-metric medium logP {self._solvent}",
+            "title,logP of " + sample_names,
+            sample_names,
+            sample_names + ",1",
+            "fw," + sample_df[self._fw_col],
+            "mg, " + sample_df[self._mg_col],
+        )
+        lines = lines + "\nClean Up\nClean Up"
         return "\n".join(lines)
 
 
@@ -2,8 +2,10 @@ import logging
 
 def get_logger(name):
     logger = logging.getLogger(name)
-    logging.basicConfig(
-        format="[%(levelname)s] %(asctime)s %(module)s:%(funcName)s:%(lineno)d %(msg)s",
-        level=logging.INFO,
-    )
+    # Configure the root logger only once, and leave it alone if the application has already configured it
+    if not logging.getLogger().handlers:
+        logging.basicConfig(
+            format="[%(levelname)s] %(asctime)s %(module)s:%(funcName)s:%(lineno)d %(message)s",
+            level=logging.INFO,
+        )
     return logger
@@ -1,17 +1,21 @@
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import enum
 from functools import cached_property
+import mmap
 import pathlib
 import re
-from typing import Optional, Union
+from typing import IO, Optional, Union
 
-import xmltodict
+from lxml import etree
 
 from t3_chomper.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Matches the assay category element, which appears once near the top of t3r files
+_CATEGORY_RE = re.compile(rb"<Category>(\w+)</Category>")
+
 ## TODO:
 ## - How to ensure the right logP
 ## - What other values do we want to extract from result files?
@@ -22,10 +26,12 @@ class CaseInsensitiveStrEnum(enum.StrEnum):
 
     @classmethod
     def _missing_(cls, value):
-        for member in cls:
-            value = str(value).lower()
-            if member.value == value:
-                return member
+        # Build the lowercase lookup once per enum class, on first miss
+        lookup = cls.__dict__.get("_lowercase_lookup")
+        if lookup is None:
+            lookup = {member.value.lower(): member for member in cls}
+            cls._lowercase_lookup = lookup
+        return lookup.get(str(value).lower())
 
 
 class AssayCategory(CaseInsensitiveStrEnum):
@@ -47,7 +53,7 @@ class PkaType(CaseInsensitiveStrEnum):
         return self.name.lower()
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class PkaResult:
     """Container for a single pKa result or prediction"""
 
@@ -59,7 +65,7 @@ class PkaResult:
     source: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class LogPResult:
     """Container for a single logP result"""
 
@@ -71,12 +77,43 @@ class LogPResult:
 def get_assay_category(filename: Union[str, pathlib.Path]) -> AssayCategory:
     """Utility function to quickly get the assay category for a provided t3r file"""
 
-    with open(filename) as fin:
-        res = re.findall(r"<Category>(\w+)</Category>", fin.read())
-    if len(res) == 1:
-        return AssayCategory(res[0])
-    else:
+    # Search the memory-mapped file, which stops at the first match without reading the rest of the file
+    with open(filename, "rb") as fin:
+        if fin.seek(0, 2) == 0:
+            raise ValueError("Could not determine assay category")
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            match = _CATEGORY_RE.search(mm)
+            # The match reads from the mapped file, so take the value before it is unmapped
+            value = match.group(1).decode() if match else None
+    if value is None:
         raise ValueError("Could not determine assay category")
+    return AssayCategory(value)
+
+
+def _find_text(elem: etree._Element, path: str) -> str:
+    """Return the text of the first subelement matching path, raising KeyError if it is not found"""
+    text = elem.findtext(path)
+    if text is None:
+        raise KeyError(path)
+    return text
+
+
+# Types of file contents that are parsed in place, without being copied
+_BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+class _BufferReader:
+    """Read-only file object over a buffer, which copies out one chunk per read rather than the whole buffer"""
+
+    def __init__(self, buffer) -> None:
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size < 0 else self._pos + size
+        chunk = self._view[self._pos : end].tobytes()
+        self._pos += len(chunk)
+        return chunk
 
 
 class BaseT3RParser:
@@ -84,13 +121,60 @@ class BaseT3RParser:
     Base class for parsing data from T3R files.
     Subclasses can be defined for specific experimental protocols.
     This base class defines properties common to all t3r result files.
+    Values are read from the parsed XML tree with XPath expressions, which are compiled once at class level.
+
+    Args:
+        filename: t3r result file
+        low_memory: if True, drop the content of large elements that are never read (e.g. the recorded
+            instrument events) while the file is parsed. This roughly halves the size of the tree kept in
+            memory, but parsing is slower.
+        data: contents of the file, if they have already been read, as bytes, a memory map or a binary file
+            object. The file is then not read again. Buffers such as a memory map are parsed in place,
+            without copying them.
     """
 
     EXPECTED_ASSAY_CATEGORY = None
 
-    def __init__(self, filename: Union[str, pathlib.Path]) -> None:
+    # Shared by all parser instances; each worker process gets its own copy, so it is never used concurrently
+    _XML_PARSER = etree.XMLParser(
+        huge_tree=True, collect_ids=False, remove_blank_text=True
+    )
+    # Large elements whose content is not used, emptied as they are parsed in low_memory mode
+    _UNUSED_TAGS = (
+        "RecordedEvents",
+        "InstrumentSetup",
+        "ImportedBufferCalibration",
+        "Spectrum",
+    )
+
+    _XP_ASSAY_NAME = etree.XPath(
+        "/DirectControlAssayResultsFile/Summary/AssayName/text()", smart_strings=False
+    )
+    _XP_START_TIME = etree.XPath(
+        "/DirectControlAssayResultsFile/Summary/StartTime/text()", smart_strings=False
+    )
+    _XP_SAMPLE_NAME = etree.XPath(
+        "/DirectControlAssayResultsFile/Summary/SampleName/text()", smart_strings=False
+    )
+    _XP_CATEGORY = etree.XPath(
+        "/DirectControlAssayResultsFile/AssayData/AssayTemplate/Category/text()",
+        smart_strings=False,
+    )
+    _XP_QUALITY = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/AssayQuality/Quality/text()",
+        smart_strings=False,
+    )
+
+    def __init__(
+        self,
+        filename: Union[str, pathlib.Path],
+        low_memory: bool = False,
+        data: Optional[Union[bytes, mmap.mmap, IO[bytes]]] = None,
+    ) -> None:
         self._filename = pathlib.Path(filename)
-        self._doc: dict = {}
+        self._low_memory = low_memory
+        self._data = data
+        self._tree: Optional[etree._ElementTree] = None
         self._load_document()
 
         if self.assay_category != self.EXPECTED_ASSAY_CATEGORY:
@@ -98,43 +182,75 @@ class BaseT3RParser:
 
     def _load_document(self):
         try:
-            with open(self.filename, "rb") as fin:
-                self._doc = xmltodict.parse(fin)
-                logger.info(f"Loaded file {self.filename}")
+            if self._low_memory:
+                self._tree = self._parse_pruned()
+            elif isinstance(self._data, _BUFFER_TYPES):
+                # fromstring parses the buffer directly, where parsing from a file object would copy it
+                self._tree = etree.fromstring(
+                    self._data, parser=self._XML_PARSER
+                ).getroottree()
+            else:
+                self._tree = etree.parse(self._source(), parser=self._XML_PARSER)
+            logger.info("Loaded file %s", self.filename)
         except Exception as e:
-            logger.error(f"Error loading file: {self.filename}: {e}")
+            logger.error("Error loading file: %s: %s", self.filename, e)
+            raise
+        finally:
+            # The tree holds everything that is needed, so drop the raw contents
+            self._data = None
+
+    def _source(self) -> Union[str, IO[bytes], _BufferReader]:
+        """Source to parse the document from, either the contents passed in or the file itself"""
+        if self._data is None:
+            return str(self.filename)
+        if isinstance(self._data, _BUFFER_TYPES):
+            return _BufferReader(self._data)
+        return self._data
+
+    def _parse_pruned(self) -> etree._ElementTree:
+        """Parse the file, emptying each unused element as soon as it has been read"""
+        context = etree.iterparse(
+            self._source(),
+            events=("end",),
+            tag=self._UNUSED_TAGS,
+            huge_tree=True,
+            collect_ids=False,
+            remove_blank_text=True,
+        )
+        for _, elem in context:
+            elem.clear()
+        return context.root.getroottree()
+
+    def _xpath_text(self, xpath: etree.XPath) -> str:
+        """Return the first text result of a compiled XPath, raising KeyError if it is not found"""
+        result = xpath(self._tree)
+        if not result:
+            raise KeyError(xpath.path)
+        return result[0]
 
     @property
     def filename(self) -> pathlib.Path:
         return self._filename
 
-    @property
+    @cached_property
     def assay_name(self) -> str:
-        return self._doc["DirectControlAssayResultsFile"]["Summary"]["AssayName"]
+        return self._xpath_text(self._XP_ASSAY_NAME)
 
-    @property
+    @cached_property
     def assay_datetime(self) -> datetime:
-        str_datetime = self._doc["DirectControlAssayResultsFile"]["Summary"][
-            "StartTime"
-        ]
-        return datetime.fromisoformat(str_datetime)
+        return datetime.fromisoformat(self._xpath_text(self._XP_START_TIME))
 
-    @property
+    @cached_property
     def assay_category(self) -> AssayCategory:
-        val = self._doc["DirectControlAssayResultsFile"]["AssayData"]["AssayTemplate"][
-            "Category"
-        ]
-        return AssayCategory(val)
+        return AssayCategory(self._xpath_text(self._XP_CATEGORY))
 
-    @property
+    @cached_property
     def assay_quality(self) -> str:
-        return self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-            "AssayQuality"
-        ]["Quality"]
+        return self._xpath_text(self._XP_QUALITY)
 
-    @property
+    @cached_property
     def sample_name(self) -> str:
-        return self._doc["DirectControlAssayResultsFile"]["Summary"]["SampleName"]
+        return self._xpath_text(self._XP_SAMPLE_NAME)
 
 
 class UVMetricPKaT3RParser(BaseT3RParser):
@@ -144,7 +260,19 @@ class UVMetricPKaT3RParser(BaseT3RParser):
 
     EXPECTED_ASSAY_CATEGORY = AssayCategory.PKA
 
-    @property
+    _XP_FASTDPAS_MEAN_RESULT = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/FastDpasMeanResult"
+    )
+    _XP_DIELECTRIC_FITS = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/YasudaShedlovskyResult"
+        "/DielectricFit/YasudaShedlovskyFit"
+    )
+    _XP_PREDICTED_PKAS = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/PhMetricModel/Sample/Pka"
+    )
+    _XP_SWEEPS = etree.XPath("/DirectControlAssayResultsFile/ProcessedData/Sweep")
+
+    @cached_property
     def result_list(self) -> list[dict]:
         """
         Return result summary as a list of dict objects, one for each pKa
@@ -169,7 +297,7 @@ class UVMetricPKaT3RParser(BaseT3RParser):
             )
         return results
 
-    @property
+    @cached_property
     def result_dict(self) -> dict:
         """
         Return a result summary as a single dict
@@ -190,60 +318,66 @@ class UVMetricPKaT3RParser(BaseT3RParser):
             "reformatted_pkas": self.t3_formatted_results,
         }
 
-    @property
+    @cached_property
     def _fastdpas_mean_results(self) -> list[PkaResult]:
         """
         pKa result(s) from the "FastDpasMeanResult" element
         Assumes that multiple pKas are found as space-separated values under the element named:
         "ProcessedData.FastDPasMeanResult.MeanPkaResults"
         """
-        obj = self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-            "FastDpasMeanResult"
-        ]
-        num_pkas = int(obj["MeanPkaResults"]["@size"])
+        found = self._XP_FASTDPAS_MEAN_RESULT(self._tree)
+        if not found:
+            raise KeyError("FastDpasMeanResult")
+        obj = found[0]
+
+        def split_field(tag: str) -> list[str]:
+            return _find_text(obj, tag).split(" ")
+
+        mean_pkas = obj.find("MeanPkaResults")
+        size = mean_pkas.get("size") if mean_pkas is not None else None
+        if size is None:
+            raise KeyError("MeanPkaResults/@size")
+        num_pkas = int(size)
+        # Each field holds one space-separated value per pKa, so split each field once
+        values = split_field("MeanPkaResults")
+        stds = split_field("MeanPkasStdDevs")
+        ionic_strengths = split_field("MeanPkasAverageIonicStrength")
+        temperatures = split_field("MeanPkasAverageTemperature")
         results = []
         for pka in range(num_pkas):
             results.append(
                 PkaResult(
-                    value=float(obj["MeanPkaResults"]["#text"].split(" ")[pka]),
-                    std=float(obj["MeanPkasStdDevs"]["#text"].split(" ")[pka]),
-                    ionic_strength=float(
-                        obj["MeanPkasAverageIonicStrength"]["#text"].split(" ")[pka]
-                    ),
-                    temperature=float(
-                        obj["MeanPkasAverageTemperature"]["#text"].split(" ")[pka]
-                    ),
+                    value=float(values[pka]),
+                    std=float(stds[pka]),
+                    ionic_strength=float(ionic_strengths[pka]),
+                    temperature=float(temperatures[pka]),
                 )
             )
         return results
 
-    @property
+    @cached_property
     def _dielectric_fit_result(self) -> list[PkaResult]:
         """
         Get pKa results from the YasudaShedlovskyResult.DielectircFit element
         Assumes that pKa values are found as elements under
         "ProcessedData.YasudaShedlovskyResult.DielectricFit"
         """
-        obj = self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-            "YasudaShedlovskyResult"
-        ]["DielectricFit"]["YasudaShedlovskyFit"]
-
-        # Force to a list
-        if not isinstance(obj, list):
-            obj = [obj]
+        fits = self._XP_DIELECTRIC_FITS(self._tree)
+        if not fits:
+            raise KeyError("YasudaShedlovskyFit")
 
         results = [
             PkaResult(
-                value=float(fit["AqueousPka"]),
-                std=float(fit["ConfidenceInterval"]),
-                ionic_strength=float(fit["AverageIonicStrength"]),
-                temperature=float(fit["AverageTemperature"]),
+                value=float(_find_text(fit, "AqueousPka")),
+                std=float(_find_text(fit, "ConfidenceInterval")),
+                ionic_strength=float(_find_text(fit, "AverageIonicStrength")),
+                temperature=float(_find_text(fit, "AverageTemperature")),
             )
-            for fit in obj
+            for fit in fits
         ]
         return results
 
-    @property
+    @cached_property
     def pka_results(self) -> list[PkaResult]:
         """
         Get measured pKa results.
@@ -257,32 +391,31 @@ class UVMetricPKaT3RParser(BaseT3RParser):
                 results = self._dielectric_fit_result
             except KeyError:
                 raise KeyError(f"Could not find pKa results in file: {self.filename}")
-        for measured, predicted in zip(results, self.predicted_pka):
-            measured.pka_type = predicted.pka_type
-
-        return results
+        # Results are immutable, so copy each matched result with the type of its predicted pKa
+        predicted_pkas = self.predicted_pka
+        return [
+            replace(measured, pka_type=predicted.pka_type)
+            for measured, predicted in zip(results, predicted_pkas)
+        ] + results[len(predicted_pkas) :]
 
-    @property
+    @cached_property
     def predicted_pka(self) -> list[PkaResult]:
         """Get the predicted pKa values input into the experiment"""
-        obj = self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-            "PhMetricModel"
-        ]["Sample"]["Pka"]
-
-        if not isinstance(obj, list):
-            obj = [obj]
+        preds = self._XP_PREDICTED_PKAS(self._tree)
+        if not preds:
+            raise KeyError("PhMetricModel/Sample/Pka")
 
         return [
             PkaResult(
-                value=float(pred["PkaValue"]["Value"]),
+                value=float(_find_text(pred, "PkaValue/Value")),
                 std=None,
-                pka_type=PkaType(pred["PkaType"]["Value"]),
-                source=pred["PkaValue"]["Source"],
+                pka_type=PkaType(_find_text(pred, "PkaType/Value")),
+                source=pred.findtext("PkaValue/Source"),
             )
-            for pred in obj
+            for pred in preds
         ]
 
-    @property
+    @cached_property
     def t3_formatted_results(self) -> str:
         """
         SririusT3-formatted pKa results
@@ -297,39 +430,33 @@ class UVMetricPKaT3RParser(BaseT3RParser):
             for pred, meas in zip(predicted_pkas, measured_pkas)
         )
 
-    @property
+    @cached_property
     def cosolvent_name(self) -> str | None:
         """
         Get Name of cosolvent used
         """
-        base = self._doc["DirectControlAssayResultsFile"]["ProcessedData"]
-        if "Sweep" not in base:
+        sweeps = self._XP_SWEEPS(self._tree)
+        if not sweeps:
             return None
-        try:
-            first_sweep = base["Sweep"][0]
-            solvent_name = first_sweep["FastDpasResult"]["CosolventRatio"][
-                "CosolventName"
-            ]
-            return solvent_name
-        except (KeyError, IndexError):
-            logger.error(f"Could not extract cosolvent name from {self.filename}")
+        solvent_name = sweeps[0].findtext("FastDpasResult/CosolventRatio/CosolventName")
+        if solvent_name is None:
+            logger.error("Could not extract cosolvent name from %s", self.filename)
+        return solvent_name
 
-    @property
+    @cached_property
     def cosolvent_fractions(self) -> list[float] | None:
         """
         Get a list of the cosolvent fractions by weight
         """
-        try:
-            sweeps = self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-                "Sweep"
-            ]
-            fractions = [
-                float(sweep["FastDpasResult"]["CosolventRatio"]["WtFraction"])
-                for sweep in sweeps
-            ]
-            return fractions
-        except (KeyError, IndexError):
-            logger.error(f"Could not extract cosolvent fractions from {self.filename}")
+        sweeps = self._XP_SWEEPS(self._tree)
+        fractions = [
+            sweep.findtext("FastDpasResult/CosolventRatio/WtFraction")
+            for sweep in sweeps
+        ]
+        if not fractions or None in fractions:
+            logger.error("Could not extract cosolvent fractions from %s", self.filename)
+            return None
+        return [float(fraction) for fraction in fractions]
 
 
 class LogPT3RParser(BaseT3RParser):
@@ -339,7 +466,22 @@ class LogPT3RParser(BaseT3RParser):
 
     EXPECTED_ASSAY_CATEGORY = AssayCategory.LOGP
 
-    @property
+    _XP_RMSD = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/MultisweepPhMetricResult/Rmsd/text()",
+        smart_strings=False,
+    )
+    _XP_LOGP_VALUES = etree.XPath(
+        "/DirectControlAssayResultsFile/ProcessedData/MultisweepPhMetricResult"
+        "/MultisweepPhMetricLevelResult/SampleValues/Logp/text()",
+        smart_strings=False,
+    )
+    _XP_PARTITION_TYPE = etree.XPath(
+        "/DirectControlAssayResultsFile/AssayData/AssayTemplate/Settings"
+        "/PartitionType/Value/text()",
+        smart_strings=False,
+    )
+
+    @cached_property
     def result_dict(self) -> dict:
         """Return parsed results as a dict"""
         return {
@@ -354,18 +496,15 @@ class LogPT3RParser(BaseT3RParser):
 
     @cached_property
     def logp_result(self) -> LogPResult:
-        data = self._doc["DirectControlAssayResultsFile"]["ProcessedData"][
-            "MultisweepPhMetricResult"
-        ]
-        rmsd = float(data["Rmsd"])
-        value_list = data["MultisweepPhMetricLevelResult"]["SampleValues"]["Logp"]
+        rmsd = float(self._xpath_text(self._XP_RMSD))
+        value_list = self._XP_LOGP_VALUES(self._tree)
+        if not value_list:
+            raise KeyError(self._XP_LOGP_VALUES.path)
         # NEED TO VERIFY THIS WILL BE CORRECT - THIS JUST TAKES THE LARGER OF TWO LOGP VALUES
         value = max(float(value) for value in value_list)
         solvent = self.logp_solvent
         return LogPResult(value=value, rmsd=rmsd, solvent=solvent)
 
-    @property
+    @cached_property
     def logp_solvent(self) -> str:
-        return self._doc["DirectControlAssayResultsFile"]["AssayData"]["AssayTemplate"][
-            "Settings"
-        ]["PartitionType"]["Value"]["#text"]
+        return self._xpath_text(self._XP_PARTITION_TYPE)
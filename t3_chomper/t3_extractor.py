@@ -1,7 +1,15 @@
 """CLI for extracting data from t3r files."""
 
+from collections import defaultdict, deque
+import csv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+from itertools import repeat
+import os
+import pickle
+import sys
 from pathlib import Path
-from typing import Union
+from typing import Iterator, Optional, Union
 
 import click
 import pandas as pd
@@ -16,38 +24,260 @@ from t3_chomper.logger import get_logger
 logger = get_logger(__name__)
 
 
+# Parser class for each assay category, and how to get result rows from a parser
+_PARSER_FOR = {
+    # Get results as list of dict objects per pKa
+    AssayCategory.PKA: (UVMetricPKaT3RParser, lambda parser: parser.result_list),
+    # Get logp result as a dict object
+    AssayCategory.LOGP: (LogPT3RParser, lambda parser: [parser.result_dict]),
+}
+
+
+# Part of every cache key, increment when parsed results change so that old cache entries are not used
+_CACHE_VERSION = 1
+
+
+def _cache_path(
+    file: Union[str, Path], protocol: AssayCategory, cache_dir: Union[str, Path]
+) -> Path:
+    """
+    Location of the cached results for a file.
+    The key includes the file's modification time and size, so a changed file gets a new entry.
+    """
+    stat = os.stat(file)
+    key = f"{_CACHE_VERSION}|{protocol.value}|{os.path.abspath(file)}|{stat.st_mtime_ns}|{stat.st_size}"
+    digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+    return Path(cache_dir) / f"{digest}.pkl"
+
+
+def _read_cache(cache_path: Path) -> Optional[list[dict]]:
+    """Return cached result rows, or None if there is no usable cache entry"""
+    try:
+        with open(cache_path, "rb") as fin:
+            return pickle.load(fin)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logger.warning("Ignoring unreadable cache entry %s: %s", cache_path, e)
+        return None
+
+
+def _write_cache(cache_path: Path, rows: list[dict]) -> None:
+    """
+    Store result rows in the cache.
+    Entries are written to a temporary file and renamed, so parallel workers never see a partial entry.
+    """
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "wb") as fout:
+            pickle.dump(rows, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("Could not write cache entry %s: %s", cache_path, e)
+
+
+def _parse_file(
+    file: Union[str, Path],
+    protocol: AssayCategory,
+    data: Optional[bytes] = None,
+    cache_dir: Union[str, Path, None] = None,
+    low_memory: bool = False,
+) -> tuple[Union[str, Path], list[dict], Optional[str]]:
+    """
+    Parse a single t3r result file.
+    This runs in worker processes, so errors are returned rather than raised, letting the other files finish.
+    Args:
+        file: t3r file to parse
+        protocol: assay category of the file
+        data: contents of the file, if they have already been read
+        cache_dir: optional directory of cached results. Results found there are returned without parsing
+            the file, and newly parsed results are added to it.
+        low_memory: parse the file in low_memory mode, see BaseT3RParser
+    Returns:
+        the file, its result rows (one per pKa for pka files, one for logp files) and an error message if parsing failed
+    """
+    logger.debug("Parsing T3R XML file: %s", file)
+    try:
+        if protocol not in _PARSER_FOR:
+            raise ValueError(f"Unknown Assay category: {protocol}")
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = _cache_path(file, protocol, cache_dir)
+            rows = _read_cache(cache_path)
+            if rows is not None:
+                return file, rows, None
+        parser_cls, get_rows = _PARSER_FOR[protocol]
+        rows = get_rows(parser_cls(file, low_memory=low_memory, data=data))
+        if cache_path is not None:
+            _write_cache(cache_path, rows)
+        return file, rows, None
+    except Exception as e:
+        return file, [], str(e)
+
+
+def _read_file(file: Path) -> Optional[bytes]:
+    """Read the contents of a file, or return None if it cannot be read so the parser reports the error"""
+    try:
+        return file.read_bytes()
+    except OSError:
+        return None
+
+
+def _prefetch_files(
+    files: list[Path], window: int
+) -> Iterator[tuple[Path, Optional[bytes]]]:
+    """
+    Read files in background threads, keeping up to `window` files read ahead of the one being parsed.
+    Reading releases the GIL, so disk I/O overlaps with parsing while memory stays bounded by the window.
+    Args:
+        files: files to read
+        window: number of files to read ahead
+    Returns:
+        iterator of (file, contents) in input order
+    """
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(_read_file, file)))
+            if len(pending) > window:
+                file, future = pending.popleft()
+                yield file, future.result()
+        for file, future in pending:
+            yield file, future.result()
+
+
+def parse_many(
+    files: list[Path],
+    protocol: AssayCategory,
+    max_workers: Optional[int] = None,
+    cache_dir: Union[str, Path, None] = None,
+    low_memory: bool = False,
+) -> Iterator[tuple[Path, list[dict], Optional[str]]]:
+    """
+    Parse t3r result files in parallel worker processes.
+    Args:
+        files: t3r files to parse
+        protocol: assay category of the files
+        max_workers: number of worker processes, defaults to the number of CPUs. At most one per file is started.
+        cache_dir: optional directory of cached results, see _parse_file
+        low_memory: parse files in low_memory mode, see BaseT3RParser
+    Returns:
+        iterator of (file, result rows, error message) for each file, as returned by _parse_file, in input order
+    """
+    # Worker processes are all started up front, so never start more than there are files
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(files)))
+    # Send each worker about four batches of files, so pickling overhead is amortized
+    # while the work still balances across workers
+    chunksize = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Paths are much slower to pickle than strings, so send plain strings to the workers and
+        # pair the results back up with the original paths, which map returns in input order
+        results = executor.map(
+            _parse_file,
+            map(str, files),
+            repeat(protocol),
+            repeat(None),
+            repeat(cache_dir),
+            repeat(low_memory),
+            chunksize=chunksize,
+        )
+        for file, (_, rows, error) in zip(files, results):
+            yield file, rows, error
+
+
 class FileOrPathExtractor:
     """
     Class to extract data from one or more t3r result files.
     """
 
-    def __init__(self, path: Union[str, Path]):
+    # Below this many files, starting worker processes costs more than it saves
+    MIN_FILES_FOR_POOL = 4
+    # Number of files read ahead in background threads when parsing in this process
+    PREFETCH_WINDOW = 4
+    # Result columns with few distinct values, which are shared and stored as categoricals
+    CATEGORICAL_COLUMNS = frozenset(
+        ["assay_name", "assay_quality", "pka_type", "cosolvent", "solvent"]
+    )
+    # Numeric result columns, which are built directly as float64 columns
+    FLOAT_COLUMNS = frozenset(
+        [
+            "pka_value",
+            "pka_std",
+            "pka_ionic_strength",
+            "pka_temperature",
+            "logp",
+            "rmsd",
+        ]
+    )
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        workers: Optional[int] = None,
+        cache_dir: Union[str, Path, None] = None,
+        recursive: bool = False,
+        low_memory: bool = False,
+    ):
         """
         Args:
             path: either string or path pointing to a single file or directory of t3r files
+            recursive: if path is a directory, also find t3r files in its subdirectories
+            workers: number of worker processes used to parse a directory of files, defaults to the number of CPUs
+            cache_dir: optional directory for caching parsed results between runs. Files that have not changed
+                since they were cached are not parsed again.
+            low_memory: parse files in low_memory mode, which reduces the memory used per file but is slower.
+                See BaseT3RParser.
         """
         self.path = Path(path)
+        self.workers = workers
+        self.recursive = recursive
+        self.low_memory = low_memory
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.num_files = None
-        self.rows = []
+        # Result rows are stored column-wise, one list of values per result field
+        self.columns = defaultdict(list)
+        self.num_rows = 0
         self.failed_filenames = []
 
         if self.path.is_dir():
-            self._t3_files = list(self.path.glob("*.t3r"))
+            self._t3_files = list(self._iter_t3_files())
             if not self._t3_files:
                 raise FileNotFoundError(f"No .t3r files found in directory: {path}")
             self.num_files = len(self._t3_files)
-            logger.info(f"Found {self.num_files} t3r results files.")
+            logger.info("Found %s t3r results files.", self.num_files)
         else:
             self._t3_files = [self.path]
             self.num_files = 1
-            logger.info(f"Found 1 t3r result file.")
+            logger.info("Found 1 t3r result file.")
+
+    def _iter_t3_files(self) -> Iterator[Path]:
+        """
+        Yield the t3r files in the directory, and in its subdirectories if recursive.
+        scandir reports the entry type from the directory listing, so no per-file stat call is needed.
+        normcase matches the extension case-insensitively on Windows, like glob does.
+        """
+        directories = [self.path]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    # Like os.walk, symlinked directories are not followed, avoiding cycles
+                    if self.recursive and entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif (
+                        os.path.normcase(entry.name).endswith(".t3r")
+                        and entry.is_file()
+                    ):
+                        yield Path(entry.path)
 
     @property
     def num_succeeded(self) -> int:
         """
         Number of successfully parsed files
         """
-        return len(self.rows)
+        return self.num_rows
 
     @property
     def num_failed(self) -> int:
@@ -56,43 +286,83 @@ class FileOrPathExtractor:
         """
         return len(self.failed_filenames)
 
+    def _parse_files(self, protocol: AssayCategory) -> None:
+        """
+        Parse all t3r files, collecting result rows and the names of files that failed to parse.
+        Files are independent, so multiple files are parsed in parallel worker processes.
+        """
+        if self.num_files >= self.MIN_FILES_FOR_POOL and self.workers != 1:
+            # Collect results as they are yielded rather than waiting for the whole batch
+            for result in parse_many(
+                self._t3_files,
+                protocol,
+                max_workers=self.workers,
+                cache_dir=self.cache_dir,
+                low_memory=self.low_memory,
+            ):
+                self._collect_result(*result)
+        elif self.num_files > 1:
+            for file, data in _prefetch_files(self._t3_files, self.PREFETCH_WINDOW):
+                self._collect_result(
+                    *_parse_file(file, protocol, data, self.cache_dir, self.low_memory)
+                )
+        else:
+            self._collect_result(
+                *_parse_file(
+                    self._t3_files[0],
+                    protocol,
+                    cache_dir=self.cache_dir,
+                    low_memory=self.low_memory,
+                )
+            )
+
+    def _collect_result(
+        self, file: Path, rows: list[dict], error: Optional[str]
+    ) -> None:
+        """
+        Record the result rows of a parsed file, or its name if parsing failed
+        """
+        if error is not None:
+            logger.error("Error parsing data: %s", error)
+            self.failed_filenames.append(file)
+        else:
+            for row in rows:
+                for key, value in row.items():
+                    # Results unpickled from worker processes are separate string objects,
+                    # so share one copy of each repeated value. Enum values such as pka_type are already shared
+                    if type(value) is str and key in self.CATEGORICAL_COLUMNS:
+                        value = sys.intern(value)
+                    self.columns[key].append(value)
+            self.num_rows += len(rows)
+
     def parse_pka_files(self) -> None:
         """
         Parse pKa result data files and return a dataframe of parsed results
         """
-        for file in self._t3_files:
-            logger.debug(f"Parsing T3R XML file: {file}")
-            try:
-                pka_parser = UVMetricPKaT3RParser(file)
-                # Get results as list of dict objects per pKa
-                results_list = pka_parser.result_list
-                self.rows.extend(results_list)
-            except Exception as e:
-                logger.error(f"Error parsing data: {e}")
-                self.failed_filenames.append(file)
+        self._parse_files(AssayCategory.PKA)
 
     def parse_logp_files(self) -> None:
         """
         Parse logp result data files and return a dataframe of parsed results
         """
-        for file in self._t3_files:
-            logger.debug(f"Parsing T3R XML file: {file}")
-            try:
-                logp_parser = LogPT3RParser(file)
-                # Get logp result as a dict object
-                result = logp_parser.result_dict
-                self.rows.append(result)
-            except Exception as e:
-                logger.error(f"Error parsing data: {e}")
-                self.failed_filenames.append(file)
+        self._parse_files(AssayCategory.LOGP)
 
     def get_results_df(self) -> pd.DataFrame:
         """
         Return results as a dataframe
         """
-        if len(self.rows) == 0:
-            logger.error(f"No parsed results")
-        return pd.DataFrame(self.rows)
+        if self.num_rows == 0:
+            logger.error("No parsed results")
+        # Give the known columns their dtype up front, so pandas does not infer it from the values
+        columns = {}
+        for col, values in self.columns.items():
+            if col in self.FLOAT_COLUMNS:
+                columns[col] = pd.Series(values, dtype="float64")
+            elif col in self.CATEGORICAL_COLUMNS:
+                columns[col] = pd.Categorical(values)
+            else:
+                columns[col] = values
+        return pd.DataFrame(columns)
 
     def write_results_csv(self, filename: Union[str, Path]) -> None:
         """
@@ -110,9 +380,12 @@ class FileOrPathExtractor:
             filename: filename for the failed filenames file
         """
         if len(self.failed_filenames) == 0:
-            logger.info(f"No files failed to parse")
-        df = pd.DataFrame({"failed_filenames": self.failed_filenames})
-        df.to_csv(filename, index=False)
+            logger.info("No files failed to parse")
+        # A single column of names does not need a dataframe; csv.writer quotes names the same way to_csv does
+        with open(filename, "w", newline="") as fout:
+            writer = csv.writer(fout, lineterminator=os.linesep)
+            writer.writerow(["failed_filenames"])
+            writer.writerows([name] for name in self.failed_filenames)
 
 
 @click.command()
@@ -128,9 +401,41 @@ class FileOrPathExtractor:
 @click.option(
     "--protocol", required=True, type=click.Choice(AssayCategory, case_sensitive=False)
 )
-def t3_extract(path, output, protocol):
+@click.option(
+    "--workers",
+    required=False,
+    default=None,
+    type=click.IntRange(min=1),
+    help="Number of worker processes for parsing a directory of files (default: number of CPUs)",
+)
+@click.option(
+    "--cache-dir",
+    required=False,
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory for caching parsed results, so unchanged files are not parsed again on later runs",
+)
+@click.option(
+    "--recursive",
+    is_flag=True,
+    default=False,
+    help="Also parse t3r files in subdirectories of the given directory",
+)
+@click.option(
+    "--low-memory",
+    is_flag=True,
+    default=False,
+    help="Reduce the memory used to parse each file, at the cost of slower parsing",
+)
+def t3_extract(path, output, protocol, workers, cache_dir, recursive, low_memory):
     click.echo(f"Extracting data from t3r files.")
-    extractor = FileOrPathExtractor(path=path)
+    extractor = FileOrPathExtractor(
+        path=path,
+        workers=workers,
+        cache_dir=cache_dir,
+        recursive=recursive,
+        low_memory=low_memory,
+    )
 
     if protocol == AssayCategory.PKA:
         extractor.parse_pka_files()
@@ -140,14 +445,20 @@ def t3_extract(path, output, protocol):
         raise ValueError(f"Unknown Assay category: {protocol}")
 
     if output:
-        logger.info(f"Finished parsing, writing to {output}")
+        logger.info("Finished parsing, writing to %s", output)
         extractor.write_results_csv(output)
 
         failed_filenames_loc = Path(output).parent / "failed_filenames.csv"
         extractor.write_failed_csv(failed_filenames_loc)
     else:
-        logger.info(f"No output file provided, writing to stdout.")
+        logger.info("No output file provided, writing to stdout.")
         df = extractor.get_results_df()
-        click.echo(df.to_csv(index=False))
+        # Write straight to stdout rather than building the whole CSV as one string first
+        df.to_csv(click.get_text_stream("stdout"), index=False)
         if extractor.num_failed > 0:
-            logger.error(f"{extractor.num_failed} files failed to parse.")
+            logger.error("%s files failed to parse.", extractor.num_failed)
+
+
+if __name__ == "__main__":
+    # Worker processes re-import this module when they are spawned (e.g. on Windows), so only run the CLI here
+    t3_extract()
@@ -1,13 +1,37 @@
+import mmap
+
 import pytest
 
+from t3_chomper.parsers import UVMetricPKaT3RParser, LogPT3RParser
+
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def pka_result_filename():
     """example of a pKa result file"""
     return r"test/data/fast_uv_OCNT-0000018-AQ-001.t3r"
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def logp_result_filename():
     """example of a logP result file"""
     return r"test/data/logp_OCNT-0000018-AQ-001_octanol.t3r"
+
+
+@pytest.fixture(scope="session")
+def pka_mmap(pka_result_filename):
+    """memory map of the example pKa result file, shared by all tests"""
+    with open(pka_result_filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+@pytest.fixture(scope="module")
+def pka_parser(pka_result_filename):
+    """parser for the example pKa result file, parsed once per test module"""
+    return UVMetricPKaT3RParser(pka_result_filename)
+
+
+@pytest.fixture(scope="module")
+def logp_parser(logp_result_filename):
+    """parser for the example logP result file, parsed once per test module"""
+    return LogPT3RParser(logp_result_filename)
@@ -3,7 +3,8 @@ import pathlib
 import pandas as pd
 
 from test.fixtures import pka_result_filename, logp_result_filename
-from t3_chomper.t3_extractor import FileOrPathExtractor
+from t3_chomper.parsers import AssayCategory
+from t3_chomper.t3_extractor import FileOrPathExtractor, parse_many
 
 
 def test_pka_extractor(pka_result_filename):
@@ -62,3 +63,54 @@ def test_logp_extractor(logp_result_filename):
     assert df.loc[0, "logp"] == 2.12231
     assert df.loc[0, "rmsd"] == 0.0516447
     assert df.loc[0, "solvent"] == "Octanol"
+
+
+def test_parse_many(pka_result_filename, logp_result_filename):
+    files = [pathlib.Path(pka_result_filename), pathlib.Path(logp_result_filename)]
+    results = list(parse_many(files, AssayCategory.PKA, max_workers=2))
+    assert [file for file, _, _ in results] == files
+    (_, pka_rows, pka_error), (_, logp_rows, logp_error) = results
+    assert pka_error is None
+    assert len(pka_rows) == 1
+    assert logp_rows == []
+    assert logp_error is not None
+
+
+def test_extractor_cache(pka_result_filename, tmp_path):
+    cache_dir = tmp_path / "cache"
+    x = FileOrPathExtractor(pka_result_filename, cache_dir=cache_dir)
+    x.parse_pka_files()
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # The second extraction reads the cached results
+    y = FileOrPathExtractor(pka_result_filename, cache_dir=cache_dir)
+    y.parse_pka_files()
+    assert y.num_succeeded == x.num_succeeded == 1
+    assert y.get_results_df().equals(x.get_results_df())
+
+
+def test_recursive_extractor(pka_result_filename, tmp_path):
+    subdir = tmp_path / "subdir"
+    subdir.mkdir()
+    (tmp_path / "top.t3r").write_bytes(pathlib.Path(pka_result_filename).read_bytes())
+    (subdir / "nested.t3r").write_bytes(pathlib.Path(pka_result_filename).read_bytes())
+
+    assert FileOrPathExtractor(tmp_path).num_files == 1
+    x = FileOrPathExtractor(tmp_path, recursive=True)
+    assert sorted(file.name for file in x._t3_files) == ["nested.t3r", "top.t3r"]
+
+
+def test_low_memory_extractor(pka_result_filename, tmp_path):
+    for idx in range(FileOrPathExtractor.MIN_FILES_FOR_POOL):
+        (tmp_path / f"{idx}.t3r").write_bytes(
+            pathlib.Path(pka_result_filename).read_bytes()
+        )
+
+    # Parse the directory in worker processes, and the single file in this process
+    for path in [tmp_path, pka_result_filename]:
+        x = FileOrPathExtractor(path, workers=2)
+        x.parse_pka_files()
+        y = FileOrPathExtractor(path, workers=2, low_memory=True)
+        y.parse_pka_files()
+        assert y.num_failed == 0
+        assert y.get_results_df().equals(x.get_results_df())
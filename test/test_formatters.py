@@ -3,7 +3,12 @@ from io import StringIO
 import pandas as pd
 import pytest
 
-from t3_chomper.formatters import convert_long_pka_df, LogPGenerator
+from t3_chomper.formatters import (
+    convert_long_pka_df,
+    generate_registration_pka_file,
+    LogPGenerator,
+    UVMetricPSKAGenerator,
+)
 
 
 @pytest.fixture
@@ -29,6 +34,83 @@ def test_convert_long_to_short(long_pka_data):
     assert reformatted_pkas == "ACID,2.05,BASE,6.75"
 
 
+@pytest.fixture
+def registration_pka_files(tmp_path, long_pka_data):
+    """Registration file and long-format pKa file, one registered compound has no pKa data"""
+    regi_file = tmp_path / "regi.csv"
+    regi_file.write_text(
+        "Compound,Well,MW,Notes\ncpd1,A1,250.5,first\ncpd2,A2,300.2,second\n"
+    )
+    pka_file = tmp_path / "pka.csv"
+    pka_file.write_text(long_pka_data.replace("pka_estimate", "pka_value"))
+    return regi_file, pka_file
+
+
+def test_generate_registration_pka_file(registration_pka_files):
+    """
+    Test merging a registration file with a long-format pKa file.
+    Columns are matched case-insensitively and compounds without pKa data are dropped.
+    """
+    regi_file, pka_file = registration_pka_files
+    df = generate_registration_pka_file(
+        registration_csv=regi_file, pka_csv=pka_file, sample_col="Compound"
+    )
+    assert len(df) == 1
+    assert df["compound"].tolist() == ["cpd1"]
+    assert df["reformatted_pkas"].tolist() == ["ACID,2.05,BASE,6.75"]
+    assert df["well"].tolist() == ["A1"]
+    assert df["mw"].tolist() == [250.5]
+    assert df["concentration_mm"].tolist() == [10.0]
+    assert "notes" not in df.columns
+
+
+def test_generate_registration_pka_file_leading_zeros(tmp_path):
+    """
+    Test that sample IDs are matched as text, so IDs that differ only by leading zeros are kept apart
+    """
+    regi_file = tmp_path / "regi.csv"
+    regi_file.write_text("sample,well,mw\n001,A1,250.5\n1,A2,300.2\n")
+    pka_file = tmp_path / "pka.csv"
+    pka_file.write_text('sample,reformatted_pkas\n001,"ACID,2.05"\n1,"BASE,6.75"\n')
+    df = generate_registration_pka_file(registration_csv=regi_file, pka_csv=pka_file)
+    assert df["sample"].tolist() == ["001", "1"]
+    assert df["well"].tolist() == ["A1", "A2"]
+    assert df["reformatted_pkas"].tolist() == ["ACID,2.05", "BASE,6.75"]
+
+
+def test_generate_registration_pka_file_ids_matched_as_text(tmp_path, caplog):
+    """
+    Test that sample IDs must be written the same way in both files, so "001" does not match "1"
+    """
+    regi_file = tmp_path / "regi.csv"
+    regi_file.write_text("sample,well,mw\n001,A1,250.5\ncpd2,A2,300.2\n")
+    pka_file = tmp_path / "pka.csv"
+    pka_file.write_text('sample,reformatted_pkas\n1,"ACID,2.05"\ncpd2,"BASE,6.75"\n')
+    df = generate_registration_pka_file(registration_csv=regi_file, pka_csv=pka_file)
+    assert df["sample"].tolist() == ["cpd2"]
+    assert "1 rows have missing pKa data and will be dropped" in caplog.text
+
+
+def test_generate_registration_pka_file_unsorted_long_format(tmp_path, long_pka_data):
+    """
+    Test merging a long-format pKa file with regi rows that are not in sorted sample order
+    """
+    regi_file = tmp_path / "regi.csv"
+    regi_file.write_text("compound,well,mw\ncpd2,A1,300.2\ncpd1,A2,250.5\n")
+    pka_file = tmp_path / "pka.csv"
+    long_pka_data = long_pka_data.replace("pka_estimate", "pka_value")
+    pka_file.write_text(long_pka_data + "cpd2,1,base,8.1,0.02\n")
+    df = generate_registration_pka_file(
+        registration_csv=regi_file, pka_csv=pka_file, sample_col="compound"
+    )
+    assert df["compound"].tolist() == ["cpd2", "cpd1"]
+    assert df["reformatted_pkas"].tolist() == ["BASE,8.1", "ACID,2.05,BASE,6.75"]
+    generator = UVMetricPSKAGenerator.from_dataframe(df, sample_id_col="compound")
+    assert generator.generate_sample_section(generator._df) == (
+        "cpd2,BASE,8.1,SYM,A1,MW,300.2\ncpd1,ACID,2.05,BASE,6.75,SYM,A2,MW,250.5"
+    )
+
+
 @pytest.fixture
 def logp_test_data():
     """Test data for LogP generator"""
@@ -70,3 +152,84 @@ def test_logp_generator_default_solvent(logp_test_data):
     # Verify the default solvent is used
     experiment_section = generator.generate_experiment_section(generator._df)
     assert "pH-metric medium logP none" in experiment_section
+
+
+def test_generator_from_dataframe(registration_pka_files):
+    """
+    Test that a generator created from the merged dataframe matches one created from the same data as CSV
+    """
+    regi_file, pka_file = registration_pka_files
+    df = generate_registration_pka_file(
+        registration_csv=regi_file, pka_csv=pka_file, sample_col="Compound"
+    )
+    from_df = UVMetricPSKAGenerator.from_dataframe(df, sample_id_col="compound")
+    from_csv = UVMetricPSKAGenerator(
+        input_csv=StringIO(df.to_csv(index=False)), sample_id_col="compound"
+    )
+    assert from_df.input_csv is None
+    assert from_df.num_samples == from_csv.num_samples == 1
+    from_df_sections = (
+        from_df.generate_sample_section(from_df._df),
+        from_df.generate_experiment_section(from_df._df),
+    )
+    from_csv_sections = (
+        from_csv.generate_sample_section(from_csv._df),
+        from_csv.generate_experiment_section(from_csv._df),
+    )
+    assert from_df_sections == from_csv_sections
+
+
+def test_generate_registration_pka_file_missing_column(registration_pka_files):
+    """
+    Test that a registration file without a required column is rejected
+    """
+    regi_file, pka_file = registration_pka_files
+    regi_file.write_text("Compound,Well\ncpd1,A1\n")
+    with pytest.raises(ValueError, match="Expected column mw is missing"):
+        generate_registration_pka_file(
+            registration_csv=regi_file, pka_csv=pka_file, sample_col="Compound"
+        )
+
+
+def test_generator_missing_pkas():
+    """
+    Test that input with missing pKas is rejected, listing at most 20 of the sample IDs
+    """
+    data = "sample,well,mw,reformatted_pkas\n" + "".join(
+        f"cpd{i},A{i},250.5,\n" for i in range(25)
+    )
+    with pytest.raises(ValueError, match="25 missing estimated pKas") as excinfo:
+        UVMetricPSKAGenerator(input_csv=StringIO(data))
+    assert "cpd19'" in str(excinfo.value)
+    assert "cpd20'" not in str(excinfo.value)
+
+
+@pytest.mark.parametrize(
+    "row,expected",
+    [
+        (',A1,,"ACID,2.05"', "nan,ACID,2.05,SYM,A1,MW,nan"),
+        ('cpd1,,250.5,"ACID,2.05"', "cpd1,ACID,2.05,SYM,nan,MW,250.5"),
+    ],
+)
+def test_generator_missing_values(row, expected):
+    """
+    Test that missing values are written as "nan", whatever backend the input was read with
+    """
+    data = f"sample,well,mw,reformatted_pkas\n{row}\n"
+    generator = UVMetricPSKAGenerator(input_csv=StringIO(data))
+    assert generator.generate_sample_section(generator._df) == expected
+
+
+def test_logp_generator_integer_columns_with_blanks():
+    """
+    Test that integer fw/mg columns with blank cells are written as floats, with or without pyarrow
+    """
+    data = (
+        "sample,well,mw,fw,mg,reformatted_pkas\n"
+        'cpd1,A1,250.5,1,2,"ACID,2.5"\n'
+        'cpd2,A2,300.2,,,"BASE,9.3"\n'
+    )
+    generator = LogPGenerator(input_csv=StringIO(data))
+    experiment_section = generator.generate_experiment_section(generator._df)
+    assert "cpd1,cpd1,1,fw,1.0,mg, 2.0\n" in experiment_section
+    assert "cpd2,cpd2,1,fw,nan,mg, nan\n" in experiment_section
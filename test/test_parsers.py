@@ -1,5 +1,9 @@
 import datetime
 import pathlib
+import re
+import tracemalloc
+
+import pytest
 
 from t3_chomper.parsers import (
     UVMetricPKaT3RParser,
@@ -8,114 +12,222 @@ from t3_chomper.parsers import (
     PkaType,
     LogPT3RParser,
     LogPResult,
+    get_assay_category,
 )
-from test.fixtures import pka_result_filename, logp_result_filename
-
-
-def test_pka_parser(pka_result_filename):
-    """Test UVMetricPKaT3RParser class"""
-
-    x = UVMetricPKaT3RParser(pka_result_filename)
-
-    # Inherited from base class
-    assert x.EXPECTED_ASSAY_CATEGORY == AssayCategory.PKA == x.assay_category
-    assert isinstance(x.filename, pathlib.Path)
-    assert x.filename == pathlib.Path(pka_result_filename)
-    assert x.assay_name == r"Fast UV psKa"
-    assert isinstance(x.assay_datetime, datetime.datetime)
-    assert x.assay_quality == "Good"
-    assert x.sample_name == r"C:\Pion Data\pilot fragment_16\OCNT-0000018-AQ-001.xmol"
-
-    # Pka-specific
-    result_dict = x.result_dict
-    assert isinstance(x.result_dict, dict)
-    assert all(
-        key in result_dict
-        for key in [
-            "filename",
-            "sample",
-            "assay_name",
-            "pka_list",
-            "std_list",
-            "reformatted_pkas",
-        ]
-    )
-    pka_results = x.pka_results
+from test.fixtures import (
+    pka_result_filename,
+    logp_result_filename,
+    pka_parser,
+    logp_parser,
+    pka_mmap,
+)
+
+_PKA_PATH = pathlib.Path(r"test/data/fast_uv_OCNT-0000018-AQ-001.t3r")
+_LOGP_PATH = pathlib.Path(r"test/data/logp_OCNT-0000018-AQ-001_octanol.t3r")
+_PKA_KEYS = frozenset(
+    {
+        "filename",
+        "sample",
+        "assay_name",
+        "assay_quality",
+        "pka_list",
+        "std_list",
+        "ionic_strength_list",
+        "temp_list",
+        "reformatted_pkas",
+        "cosolvent",
+        "cosolvent_fractions",
+    }
+)
+_PKA_ROW_KEYS = frozenset(
+    {
+        "sample",
+        "filename",
+        "assay_name",
+        "assay_quality",
+        "pka_number",
+        "pka_type",
+        "pka_value",
+        "pka_std",
+        "pka_ionic_strength",
+        "pka_temperature",
+        "cosolvent",
+        "cosolvent_fractions",
+    }
+)
+_LOGP_KEYS = frozenset({"filename", "sample", "assay_name", "logp", "rmsd", "solvent"})
+
+
+@pytest.mark.parametrize(
+    "attr,expected",
+    [
+        ("EXPECTED_ASSAY_CATEGORY", AssayCategory.PKA),
+        ("assay_category", AssayCategory.PKA),
+        ("assay_name", r"Fast UV psKa"),
+        ("assay_quality", "Good"),
+        ("sample_name", r"C:\Pion Data\pilot fragment_16\OCNT-0000018-AQ-001.xmol"),
+        ("t3_formatted_results", r"base,8.11591"),
+        ("cosolvent_name", "DMSO"),
+    ],
+)
+def test_pka_attr(pka_parser, attr, expected):
+    """Test UVMetricPKaT3RParser attribute values"""
+    assert getattr(pka_parser, attr) == expected
+
+
+@pytest.mark.parametrize(
+    "attr,expected_type",
+    [
+        ("filename", pathlib.Path),
+        ("assay_datetime", datetime.datetime),
+        ("t3_formatted_results", str),
+        ("cosolvent_fractions", list),
+        ("result_dict", dict),
+        ("result_list", list),
+    ],
+)
+def test_pka_attr_type(pka_parser, attr, expected_type):
+    """Test UVMetricPKaT3RParser attribute types"""
+    assert isinstance(getattr(pka_parser, attr), expected_type)
+
+
+def test_pka_filename(pka_parser):
+    """Test UVMetricPKaT3RParser filename"""
+    assert pka_parser.filename == _PKA_PATH
+
+
+def test_pka_results(pka_parser):
+    """Test UVMetricPKaT3RParser measured and predicted pKas"""
+    pka_results = pka_parser.pka_results
     assert len(pka_results) == 1
     result = pka_results[0]
     assert isinstance(result, PkaResult)
-    assert result.value == 8.11591
-    assert result.std == 0.203242
+    assert result.value == pytest.approx(8.11591, rel=1e-6)
+    assert result.std == pytest.approx(0.203242, rel=1e-6)
 
-    predicted_pkas = x.predicted_pka
+    predicted_pkas = pka_parser.predicted_pka
     assert len(predicted_pkas) == 1
     predicted_pka = predicted_pkas[0]
-    assert predicted_pka.value == 8.23
+    assert predicted_pka.value == pytest.approx(8.23, rel=1e-6)
     assert predicted_pka.pka_type == PkaType.BASE
 
-    t3_formatted_results = x.t3_formatted_results
-    assert isinstance(t3_formatted_results, str)
-    assert t3_formatted_results == r"base,8.11591"
-
-    assert x.cosolvent_name == "DMSO"
-    assert isinstance(x.cosolvent_fractions, list)
-    assert len(x.cosolvent_fractions) == 3
-
-    result_dict = x.result_dict
-    assert isinstance(result_dict, dict)
-    assert all(
-        key in result_dict
-        for key in [
-            "filename",
-            "sample",
-            "assay_name",
-            "assay_quality",
-            "pka_list",
-            "std_list",
-            "ionic_strength_list",
-            "temp_list",
-            "reformatted_pkas",
-            "cosolvent",
-            "cosolvent_fractions",
-        ]
-    )
 
-    result_list = x.result_list
-    assert isinstance(result_list, list)
+def test_pka_cosolvent_fractions(pka_parser):
+    """Test UVMetricPKaT3RParser cosolvent fractions"""
+    assert len(pka_parser.cosolvent_fractions) == 3
+
+
+def test_pka_result_dict_keys(pka_parser):
+    """Test UVMetricPKaT3RParser result_dict keys"""
+    assert _PKA_KEYS <= pka_parser.result_dict.keys()
+
+
+def test_pka_result_list_keys(pka_parser):
+    """Test UVMetricPKaT3RParser result_list keys"""
+    result_list = pka_parser.result_list
     assert len(result_list) > 0
     assert isinstance(result_list[0], dict)
-    assert all(
-        key in result_list[0]
-        for key in [
-            "sample",
-            "filename",
-            "assay_name",
-            "assay_quality",
-            "pka_number",
-            "pka_type",
-            "pka_value",
-            "pka_std",
-            "pka_ionic_strength",
-            "pka_temperature",
-            "cosolvent",
-            "cosolvent_fractions",
-        ]
-    )
+    assert _PKA_ROW_KEYS <= result_list[0].keys()
 
 
-def test_logp_parser(logp_result_filename):
-    """test LogPT3RParser class"""
+@pytest.mark.parametrize(
+    "attr,expected",
+    [
+        ("EXPECTED_ASSAY_CATEGORY", AssayCategory.LOGP),
+        ("assay_category", AssayCategory.LOGP),
+        ("logp_solvent", "Octanol"),
+    ],
+)
+def test_logp_attr(logp_parser, attr, expected):
+    """Test LogPT3RParser attribute values"""
+    assert getattr(logp_parser, attr) == expected
 
-    x = LogPT3RParser(logp_result_filename)
-    assert x.assay_category == x.EXPECTED_ASSAY_CATEGORY == AssayCategory.LOGP
-    result_dict = x.result_dict
-    assert isinstance(result_dict, dict)
-    assert all(
-        key in result_dict
-        for key in ["filename", "sample", "assay_name", "logp", "rmsd", "solvent"]
-    )
-    result = x.logp_result
+
+def test_logp_filename(logp_parser):
+    """Test LogPT3RParser filename"""
+    assert logp_parser.filename == _LOGP_PATH
+
+
+def test_logp_result(logp_parser):
+    """Test LogPT3RParser logP result"""
+    result = logp_parser.logp_result
     assert isinstance(result, LogPResult)
-    assert result.value == 2.12231
-    assert result.rmsd == 0.0516447
-    assert x.logp_solvent == result.solvent == "Octanol"
+    assert result.value == pytest.approx(2.12231, rel=1e-6)
+    assert result.rmsd == pytest.approx(0.0516447, rel=1e-6)
+    assert result.solvent == "Octanol"
+
+
+def test_logp_result_dict_keys(logp_parser):
+    """Test LogPT3RParser result_dict keys"""
+    assert isinstance(logp_parser.result_dict, dict)
+    assert _LOGP_KEYS <= logp_parser.result_dict.keys()
+
+
+def test_get_assay_category(pka_result_filename, logp_result_filename):
+    """test get_assay_category utility function"""
+    assert get_assay_category(pka_result_filename) == AssayCategory.PKA
+    assert get_assay_category(logp_result_filename) == AssayCategory.LOGP
+
+
+def test_case_insensitive_enum():
+    """Enum members can be looked up regardless of case"""
+    assert PkaType("Base") == PkaType("BASE") == PkaType.BASE
+    assert AssayCategory("pKa") == AssayCategory.PKA
+    assert AssayCategory("LogP") == AssayCategory.LOGP
+
+
+def test_low_memory_parser(pka_result_filename, logp_result_filename):
+    """Test that parsing in low_memory mode gives the same results"""
+    assert (
+        UVMetricPKaT3RParser(pka_result_filename, low_memory=True).result_dict
+        == UVMetricPKaT3RParser(pka_result_filename).result_dict
+    )
+    assert (
+        LogPT3RParser(logp_result_filename, low_memory=True).result_dict
+        == LogPT3RParser(logp_result_filename).result_dict
+    )
+
+
+def test_parser_from_data(pka_result_filename):
+    """Test parsing file contents that have already been read"""
+    data = _PKA_PATH.read_bytes()
+    x = UVMetricPKaT3RParser(pka_result_filename, data=data)
+    assert x.filename == _PKA_PATH
+    assert x.result_dict == UVMetricPKaT3RParser(pka_result_filename).result_dict
+
+
+def test_parser_from_mmap(pka_result_filename, pka_mmap, pka_parser):
+    """Test parsing a memory-mapped file, which can be reused by several parsers"""
+    x = UVMetricPKaT3RParser(pka_result_filename, data=pka_mmap)
+    assert x.result_dict == pka_parser.result_dict
+    y = UVMetricPKaT3RParser(pka_result_filename, data=pka_mmap, low_memory=True)
+    assert y.result_dict == pka_parser.result_dict
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_parser_from_mmap_not_copied(pka_result_filename, pka_mmap, low_memory):
+    """Test that a memory-mapped file is parsed without copying it into memory"""
+    tracemalloc.start()
+    try:
+        UVMetricPKaT3RParser(pka_result_filename, data=pka_mmap, low_memory=low_memory)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < len(pka_mmap) / 4
+
+
+def test_pka_parser_missing_mean_results(pka_result_filename):
+    """Test that a file without FastDpasMeanResult pKas falls back to the dielectric fit results"""
+    data = re.sub(rb"<MeanPkaResults.*?</MeanPkaResults>", b"", _PKA_PATH.read_bytes())
+    x = UVMetricPKaT3RParser(pka_result_filename, data=data)
+    # The example file has no dielectric fit results either
+    with pytest.raises(KeyError, match="Could not find pKa results"):
+        x.pka_results
+
+
+def test_parser_invalid_file(pka_result_filename):
+    """Test that the error from loading an invalid file is raised"""
+    with pytest.raises(SyntaxError):
+        UVMetricPKaT3RParser(
+            pka_result_filename, data=b"<DirectControlAssayResultsFile"
+        )